@@ -23,52 +23,71 @@ try:
 except Exception:
     serial = None
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
 from sys import stdout
 import socket
 from time import sleep
 import threading
 import json
+from array import array
+from collections import deque
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
+from matplotlib.transforms import Affine2D
 
 
-def animate_serial(t, fig, lines, newspike):
+def animate_serial(t, fig, lines, newspikes, trace, head):
 
-    for row, line in enumerate(lines):
-        ydata = line.get_ydata(line)
-        ydata = np.roll(ydata, -1)
-        ydata[-1] = 1 if row == newspike[0] else 0
-        ydata = np.roll(ydata, -1)
-        ydata[-1] = 0
-        line.set_ydata(ydata)
+    width = trace.shape[1] // 2
 
-    return lines
+    # Collect the neurons that have spiked since the last frame
+    spiked = np.zeros(len(lines))
+    while newspikes:
+        row = newspikes.popleft()
+        if row < len(lines):
+            spiked[row] = 1
 
+    # Advance the ring buffer by a spike column and a blank column, writing
+    # each column twice so that the latest samples are always contiguous
+    for column in (spiked, 0):
+        head[0] = (head[0] + 1) % width
+        trace[:, head[0]] = column
+        trace[:, head[0] + width] = column
 
-def serial_thread(port, fig, spiketrains, newspike):
+    for row, line in enumerate(lines):
+        line.set_ydata(trace[row, head[0]+1:head[0]+1+width])
 
-    while True:
+    return lines
 
-        # Quit on plot close
-        if not plt.fignum_exists(fig.number):
-            break
 
-        newspike[0] = ord(port.read())
+def serial_thread(port, stop, spiketrains, newspikes):
 
-        sleep(0)  # yield to main thread
+    # Quit on plot close
+    while not stop.is_set():
 
+        # Wait for a byte, then grab everything else that has arrived; the
+        # port's read timeout returns nothing so that the stop event is
+        # checked even when the device is quiet
+        newspikes.extend(port.read(max(1, port.in_waiting)))
 
-def client_thread(client, fig, spiketrains, n_neurons, connected):
 
-    while True:
+def client_thread(client, stop, spiketrains, n_neurons, connected):
 
-        # Quit on plot close
-        if not plt.fignum_exists(fig.number):
-            break
+    # Quit on plot close
+    while not stop.is_set():
 
-        msg = client.recv(n_neurons)
+        # Time out periodically to check for plot close even when the
+        # server is quiet
+        try:
+            msg = client.recv(n_neurons)
+        except socket.timeout:
+            continue
 
         counts = [count for count in msg]
 
@@ -83,39 +102,56 @@ def client_thread(client, fig, spiketrains, n_neurons, connected):
 
 def animate_client(frame, spiketrains, ticks, showcounts, connected):
 
+    # Artists to be redrawn by blitting
+    artists = []
+
     for spiketrain in spiketrains:
 
         count = spiketrain['count']
 
-        # Add count as a legend if indicated
+        # Update count label if indicated
         if showcounts:
-            spiketrain['ax'].legend(['%d' % count], handlelength=0,
-                                    loc='lower left',
-                                    bbox_to_anchor=(0.01, 0.005))
+            spiketrain['label'].set_text('%d' % count)
+            artists.append(spiketrain['label'])
 
         if connected[0] and count > 0:
 
             period = int(np.round(100 / count))
 
+            ax = spiketrain['ax']
             lines = spiketrain['lines']
+            trans = spiketrain['trans']
+
+            # Current horizontal offset of the spike train
+            offset = trans.get_matrix()[0, 2]
 
-            # Add a new spike periodically
+            # Add a new spike periodically, at the right edge, keeping its
+            # position alongside so the line's data need not be read back
             if ticks[0] % period == 0:
-                lines.append(spiketrain['ax'].plot((100, 100), (0, 1), 'k'))
+                x0 = 100 - offset
+                ln, = ax.plot((x0, x0), (0, 1), 'k', animated=True,
+                              transform=trans + ax.transData)
+                lines.append((ln, x0))
 
             # Prune spikes as the move left outside the window
-            if len(lines) > 0 and lines[0][0].get_xdata()[0] < 0:
-                lines.pop(0)
+            if len(lines) > 0 and lines[0][1] + offset < 0:
+                lines.pop(0)[0].remove()
 
             # Shift spikes to left
-            for line in lines:
-                ln = line[0]
-                xdata = ln.get_xdata()
-                ln.set_xdata(xdata - 1)
+            trans.translate(-1, 0)
+
+        # Redraw every train's spikes, so that quiet trains stay on screen
+        artists.extend(ln for ln, _ in spiketrain['lines'])
 
     ticks[0] += 1
 
-    sleep(0.01)
+    return artists
+
+
+def make_label(ax):
+
+    return ax.annotate('', xy=(0.01, 0.05), xycoords='axes fraction',
+                       animated=True)
 
 
 def set_axis_properties(ax, neuron_ids, index, is_last):
@@ -132,11 +168,12 @@ def set_axis_properties(ax, neuron_ids, index, is_last):
 
 def load_neuron_aliases(filename):
 
-    # Load network from JSON file
-    network = json.loads(open(filename).read())
+    # Load network from JSON file, using the faster parser if available
+    with open(filename, 'rb') as f:
+        network = (orjson or json).loads(f.read())
 
     # Get neuron aliases by sorting node ids from network JSON
-    return sorted([int(node['id']) for node in network['Nodes']])
+    return sorted(int(node['id']) for node in network['Nodes'])
 
 
 def run_socket(args, fig, axes, spiketrains, ticks, total_neurons):
@@ -160,20 +197,27 @@ def run_socket(args, fig, axes, spiketrains, ticks, total_neurons):
                   (args.address, port))
             sleep(1)
 
-    connected = [True]
+    # Time out blocking reads so that the client thread can quit
+    client.settimeout(0.1)
+
+    connected = array('b', [True])
+
+    # Signal the client thread to quit on plot close
+    stop = threading.Event()
+    fig.canvas.mpl_connect('close_event', lambda event: stop.set())
 
     # Start the client thread
     thread = threading.Thread(
             target=client_thread,
-            args=(client, fig, spiketrains, total_neurons, connected))
+            args=(client, stop, spiketrains, total_neurons, connected))
 
     thread.start()
 
     # Start the animation thread
     anim = animation.FuncAnimation(
-            fig, animate_client, interval=1,
+            fig, animate_client, interval=10,
             fargs=(spiketrains, ticks, args.display_counts, connected),
-            blit=False, cache_frame_data=False)
+            blit=True, cache_frame_data=False)
 
     return anim
 
@@ -181,17 +225,22 @@ def run_socket(args, fig, axes, spiketrains, ticks, total_neurons):
 def run_serial(args, fig, axes, spiketrains):
 
     try:
-        port = serial.Serial(args.port, 115200)
+        port = serial.Serial(args.port, 115200, timeout=0.1)
 
     except Exception:
         print('Unable to open connection to %s' % args.port)
         return
 
-    newspike = [-1]  # Start with OOB neuron index
+    # Queue of neuron indices, one per spike
+    newspikes = deque(maxlen=256)
+
+    # Signal the data-acquisition thread to quit on plot close
+    stop = threading.Event()
+    fig.canvas.mpl_connect('close_event', lambda event: stop.set())
 
     # Start the data-acquisition thread
     thread = threading.Thread(
-            target=serial_thread, args=(port, fig, spiketrains, newspike))
+            target=serial_thread, args=(port, stop, spiketrains, newspikes))
 
     thread.start()
 
@@ -202,9 +251,13 @@ def run_serial(args, fig, axes, spiketrains):
     y = np.zeros(100)
     lines = [ax.plot(x, y, 'k', animated=True)[0] for ax in axes]
 
+    # Doubled ring buffer of spike samples, one row per neuron
+    trace = np.zeros((len(lines), 2*len(x)))
+    head = array('q', [0])
+
     anim = animation.FuncAnimation(
             fig, animate_serial, interval=1,
-            fargs=(fig, lines, newspike),
+            fargs=(fig, lines, newspikes, trace, head),
             blit=True, cache_frame_data=False)
 
     return anim
@@ -235,6 +288,9 @@ def main():
                       if args.filename is not None
                       else list(range(args.neuron_count)))
 
+    # Map each neuron alias to its index in the received counts
+    alias_to_index = {alias: k for k, alias in enumerate(neuron_aliases)}
+
     # Get desired neuron IDs to plot from command line
     neuron_ids = (neuron_aliases
                   if args.ids == 'all'
@@ -242,7 +298,7 @@ def main():
 
     # Bozo filter
     for neuron_id in neuron_ids:
-        if neuron_id not in neuron_aliases:
+        if neuron_id not in alias_to_index:
             print('Neuron %d not in network; quitting' % neuron_id)
             exit(1)
 
@@ -259,8 +315,11 @@ def main():
             set_axis_properties(ax, neuron_ids, k, k == len(axes)-1)
 
         # Make list of spike-train info
-        spiketrains = [{'ax': ax, 'lines': [], 'count': 0,
-                        'index': neuron_aliases.index(nid)}
+        spiketrains = [{'ax': ax, 'lines': [], 'trans': Affine2D(),
+                        'count': 0,
+                        'label': (make_label(ax) if args.display_counts
+                                  else None),
+                        'index': alias_to_index[nid]}
                        for ax, nid in zip(axes, neuron_ids)]
 
     # Just one neuron
@@ -268,15 +327,18 @@ def main():
 
         set_axis_properties(axes, neuron_ids, 0, True)
 
-        spiketrains = [{'ax': axes, 'lines': [], 'count': 0,
-                        'index': neuron_aliases.index(neuron_ids[0])}]
+        spiketrains = [{'ax': axes, 'lines': [], 'trans': Affine2D(),
+                        'count': 0,
+                        'label': (make_label(axes) if args.display_counts
+                                  else None),
+                        'index': alias_to_index[neuron_ids[0]]}]
 
     plt.suptitle(args.title)
 
     total_neurons = len(neuron_aliases)
 
     # Create timestep count, to be shared between threads
-    ticks = [0]
+    ticks = array('q', [0])
 
     # Address and port; run as client
     if args.address is not None:
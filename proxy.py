@@ -32,7 +32,8 @@ while True:
 
     try:
 
-        conn.send(pack('III', 30, 40, 200))
+        # One unsigned byte per neuron
+        conn.send(pack('BBB', 30, 40, 200))
 
     except Exception:
 
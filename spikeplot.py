@@ -19,78 +19,396 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from sys import stdout
-from struct import unpack
 import socket
-from time import sleep
+import selectors
+from time import sleep, monotonic
 import threading
+import queue
+import subprocess
 import argparse
+from dataclasses import dataclass, field
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+from matplotlib.collections import LineCollection
+from matplotlib.transforms import Affine2D
+
+# Maximum number of spikes visible at once in a spike train
+POOL = 100
+
+# Maximum number of frames of counts to receive at once
+DRAIN = 64
+
+# Maximum number of video frames waiting to be encoded
+VIDEO_QUEUE = 100
+
+# Frame rate of saved video
+VIDEO_FPS = 30
+
+
+@dataclass(slots=True)
+class SpikeState:
+    '''
+    Spike-train state for all neurons, stored as one array per quantity and
+    shared between the client thread and the animation. The client thread
+    accumulates received counts in pending, under the lock.
+    '''
+
+    axes: list
+    labels: list
+    collections: list
+    transforms: list
+    segs: np.ndarray
+    lws: np.ndarray
+    heads: np.ndarray
+    counts: np.ndarray
+    periods: np.ndarray
+    pending: np.ndarray
+    packets: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    ticks: int = 0
+    connected: bool = True
+
+
+def make_state(axes, showvals):
+
+    n_neurons = len(axes)
+
+    # Preallocate hidden spike segments, to be recycled as ring buffers
+    segs = np.empty((n_neurons, POOL, 2, 2))
+    segs[:, :, :, 0] = np.nan
+    segs[:, :, :, 1] = (0, 1)
+    lws = np.ones((n_neurons, POOL))
+
+    transforms = [Affine2D() for _ in axes]
+
+    # Draw all spikes in each train as a single collection, whose paths are
+    # views of the segment array so that spikes can be updated in place
+    collections = [LineCollection(segs[k], colors='k', linewidths=lws[k],
+                                  animated=True,
+                                  transform=transforms[k] + ax.transData)
+                   for k, ax in enumerate(axes)]
+
+    for ax, lc in zip(axes, collections):
+        ax.add_collection(lc, autolim=False)
+
+    return SpikeState(axes=list(axes),
+                      labels=([make_label(ax) for ax in axes]
+                              if showvals else []),
+                      collections=collections,
+                      transforms=transforms,
+                      segs=segs,
+                      lws=lws,
+                      heads=np.zeros(n_neurons, dtype=np.int32),
+                      counts=np.zeros(n_neurons, dtype=np.uint8),
+                      periods=np.zeros(n_neurons, dtype=np.int32),
+                      pending=np.zeros(n_neurons, dtype=np.uint32))
+
+
+def threadfun(client, stop, state):
+
+    n_neurons = len(state.counts)
+    framesize = n_neurons
+
+    # Receive counts into a persistent buffer big enough for several frames
+    buf = bytearray(framesize * DRAIN)
+    mv = memoryview(buf)
+    have = 0
+
+    # Block until the server sends something, instead of polling
+    sel = selectors.DefaultSelector()
+    sel.register(client, selectors.EVENT_READ)
+
+    # Quit on plot close
+    while not stop.is_set():
+
+        # Wake up periodically to check for plot close
+        if not sel.select(timeout=0.1):
+            continue
+
+        # Drain whatever has arrived in a single call
+        try:
+            nbytes = client.recv_into(mv[have:], len(buf) - have,
+                                      socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            continue
+
+        # No data on a readable socket means the server has closed the
+        # connection
+        if nbytes == 0:
+            state.connected = False
+            break
 
+        have += nbytes
 
-def threadfun(client, fig, spiketrains, n_neurons, connected, logarithmic):
+        # Accumulate every complete frame of counts for the animation
+        end = have - have % framesize
+        if end > 0:
+            frames = np.frombuffer(buf, np.uint8, end).reshape(-1, n_neurons)
+            with state.lock:
+                state.pending += frames.sum(axis=0, dtype=np.uint32)
+                state.packets += len(frames)
 
-    while True:
+        # Keep any partial frame for the next call
+        buf[:have-end] = buf[end:have]
+        have -= end
 
-        # Quit on plot close
-        if not plt.fignum_exists(fig.number):
-            break
+    sel.close()
+
+
+class BlitManager:
+    '''
+    Redraws a fixed set of animated artists over a cached background, which
+    is recaptured whenever the whole figure is drawn
+    '''
+
+    def __init__(self, canvas, artists):
+
+        self.canvas = canvas
+        self.artists = artists
+        self.background = None
+
+        for artist in artists:
+            artist.set_animated(True)
+
+        canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+
+        for artist in self.artists:
+            self.canvas.figure.draw_artist(artist)
+
+    def update(self):
+
+        # Wait for the first full draw to capture the background
+        if self.background is None:
+            return False
+
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+        return True
+
+
+class VideoWriter:
+    '''
+    Pipes displayed frames as raw RGBA to an ffmpeg process, from a
+    background thread so that encoding overlaps the live display. Each
+    frame is repeated as needed to keep the video's fixed frame rate in step
+    with wall-clock time.
+    '''
+
+    def __init__(self, filename, fps):
+
+        self.filename = filename
+        self.fps = fps
+        self.size = None
+        self.proc = None
+        self.failed = False
+        self.start_time = None
+        self.written = 0
+        self.frames = queue.Queue(maxsize=VIDEO_QUEUE)
+        self.thread = threading.Thread(target=self.run)
+
+    def add_frame(self, canvas):
+
+        if self.failed:
+            return
+
+        size = canvas.get_width_height(physical=True)
+
+        # Start ffmpeg on the first frame, once the canvas size is known
+        if self.proc is None:
+            self.start(size)
+            if self.failed:
+                return
+
+        # Skip frames that no longer fit the video after a resize
+        if size != self.size:
+            return
+
+        # Number of video frames due by now; frames skipped because of slow
+        # ticks or a full queue are made up by repeating the next one
+        due = (int((monotonic() - self.start_time) * self.fps) + 1 -
+               self.written)
+
+        if due <= 0:
+            return
+
+        try:
+            self.frames.put_nowait((bytes(canvas.buffer_rgba()), due))
+            self.written += due
+        except queue.Full:
+            pass
+
+    def start(self, size):
+
+        self.size = size
+
+        try:
+            self.proc = subprocess.Popen(
+                    [plt.rcParams['animation.ffmpeg_path'],
+                     '-loglevel', 'error',
+                     '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                     '-s', '%dx%d' % size, '-r', '%g' % self.fps,
+                     '-i', '-'] + self.output_args() +
+                    ['-y', self.filename],
+                    stdin=subprocess.PIPE)
+        except OSError as err:
+            print('Unable to run ffmpeg (%s); not saving video' % err)
+            self.failed = True
+            return
+
+        self.start_time = monotonic()
+        self.thread.start()
+
+    def output_args(self):
 
-        counts = unpack('I'*n_neurons, client.recv(4*n_neurons))
+        # Use a palette pass for GIFs, as matplotlib's FFMpegWriter does
+        if self.filename.lower().endswith('.gif'):
+            return ['-filter_complex',
+                    'split [a][b];[a] palettegen [p];[b][p] paletteuse']
 
-        if len(counts) > 0:
-            for k,s in enumerate(spiketrains):
-                s['count'] = counts[k]
-        else:
-            connected[0] = False
+        # Otherwise use h264 in yuv420p, which players such as QuickTime and
+        # browsers require, and which needs even dimensions
+        return ['-vcodec', 'h264', '-pix_fmt', 'yuv420p',
+                '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2']
 
-        sleep(.001)  # yield
+    def run(self):
 
+        while True:
 
-def animfun(frame, spiketrains, ticks, showvals, connected, logarithmic,
-            time):
+            item = self.frames.get()
 
-    for spiketrain in spiketrains:
+            if item is None:
+                break
 
-        rawcount = spiketrain['count'] 
+            # Keep draining the queue if ffmpeg has quit, so that close()
+            # cannot block
+            if self.failed:
+                continue
 
-        count = np.log(rawcount+1) if logarithmic else rawcount
+            frame, repeat = item
 
-        # Add count as a legend if indicated
-        if showvals:
-            spiketrain['ax'].legend(['%d' % rawcount], handlelength=0,
-                                    loc='lower left',
-                                    bbox_to_anchor=(0.01, 0.005))
+            try:
+                for _ in range(repeat):
+                    self.proc.stdin.write(frame)
+            except OSError:
+                self.failed = True
 
-        if connected[0] and count > 0:
+    def close(self):
+        '''
+        Finishes the video, returning True if it was written successfully
+        '''
 
-            period = int(np.round((100000/time) / count))
+        if self.proc is None:
+            return False
 
-            lines = spiketrain['lines']
+        self.frames.put(None)
+        self.thread.join()
 
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            self.failed = True
+
+        return self.proc.wait() == 0 and not self.failed
+
+
+def make_period_table(interval, logarithmic):
+
+    # Spikes advance one tick per timer interval
+    ticks_per_second = 1000 / interval
+
+    counts = np.arange(1, 256)
+    rates = np.log1p(counts) if logarithmic else counts
+
+    # Spike period in ticks for every possible count, with zero for no
+    # spikes
+    table = np.zeros(256, dtype=np.int32)
+    table[1:] = np.round(ticks_per_second / rates)
+
+    return table
+
+
+def animfun(state, period_table):
+
+    # Average the counts received since the last tick, so that frames
+    # arriving between ticks are not dropped
+    with state.lock:
+        if state.packets > 0:
+            state.counts[:] = np.round(state.pending / state.packets)
+            state.pending[:] = 0
+            state.packets = 0
+
+    rawcounts = state.counts
+
+    # Update count labels, which exist only if indicated
+    for label, rawcount in zip(state.labels, rawcounts):
+        label.set_text('%d' % rawcount)
+
+    active = rawcounts > 0
+
+    # Look up spike periods for all neurons at once
+    state.periods[:] = period_table[rawcounts]
+
+    if not state.connected:
+        return
+
+    for k in np.flatnonzero(active):
+
+        period = state.periods[k]
+        segs = state.segs[k]
+        lws = state.lws[k]
+        lc = state.collections[k]
+        trans = state.transforms[k]
+
+        # Current horizontal offset of the spike train
+        offset = trans.get_matrix()[0, 2]
+
+        # Recycle the oldest segment periodically, at the right edge
+        if period == 0 or state.ticks % period == 0:
+            head = state.heads[k]
+            segs[head, :, 0] = 100 - offset
             # If spikes are coming faster than we can plot them, use a thick
             # line
             lw = 20 if period == 0 else 1
+            if lws[head] != lw:
+                lws[head] = lw
+                lc.set_linewidths(lws)
+            state.heads[k] = (head + 1) % POOL
+            lc.stale = True
+
+        # Hide spikes as the move left outside the window
+        gone = segs[:, 0, 0] + offset < 0
+        if gone.any():
+            segs[gone, :, 0] = np.nan
+            lc.stale = True
+
+        # Shift spikes to left
+        trans.translate(-1, 0)
+
+    state.ticks += 1
 
-            # Otherwise add a new line periodically
-            if period == 0 or ticks[0] % period == 0:
-                lines.append(spiketrain['ax'].plot((100, 100), (0, 1), 'k',
-                                                   linewidth=lw))
 
-            # Prune spikes as the move left outside the window
-            if len(lines) > 0 and lines[0][0].get_xdata()[0] < 0:
-                lines.pop(0)
+def animate(state, period_table, blitter, video):
 
-            # Shift spikes to left
-            for line in lines:
-                ln = line[0]
-                xdata = ln.get_xdata()
-                ln.set_xdata(xdata - 1)
+    animfun(state, period_table)
 
-    ticks[0] += 1
+    # Record only frames that have actually been drawn
+    if blitter.update() and video is not None:
+        video.add_frame(blitter.canvas)
 
-    sleep(0.01)
+
+def make_label(ax):
+
+    return ax.annotate('', xy=(0.01, 0.05), xycoords='axes fraction',
+                       animated=True)
 
 
 def make_axis(ax, neuron_ids, index, time, logarithmic, is_last):
@@ -120,9 +438,15 @@ def parse_args():
     parser.add_argument('-l', '--logarithmic', help='use logarithm of counts',
                         action='store_true')
     parser.add_argument('-s', '--timespan', type=int, default=1000,
-                        help='Time span in milliseconds')
+                        help='Time span in milliseconds, a multiple of 100')
+
+    args = parser.parse_args()
+
+    # The window is 100 ticks of a whole number of milliseconds each
+    if args.timespan < 100 or args.timespan % 100 != 0:
+        parser.error('time span must be a positive multiple of 100 msec')
 
-    return parser.parse_args()
+    return args
 
 
 def main():
@@ -134,29 +458,16 @@ def main():
     neuron_ids = args.ids.strip().split(',')
 
     # Create figure and axes in which to plot spike trains
-    fig, axes = plt.subplots(len(neuron_ids))
+    fig, axes = plt.subplots(len(neuron_ids), squeeze=False)
+    axes = axes[:, 0]
 
-    # Multiple neurons
-    if isinstance(axes, np.ndarray):
+    for k, ax in enumerate(axes):
 
-        for k, ax in enumerate(axes):
+        make_axis(ax, neuron_ids, k, args.timespan, args.logarithmic,
+                  k == len(axes)-1)
 
-            make_axis(ax, neuron_ids, k, args.timespan, args.logarithmic,
-                      k == len(axes)-1)
-
-        # Make list of spike-train info
-        spiketrains = [{'ax': ax, 'lines': [], 'count': 0}
-                       for ax, nid in zip(axes, neuron_ids)]
-
-    # Just one neuron
-    else:
-
-        make_axis(axes, neuron_ids, 0, args.logarithmic, True)
-
-        spiketrains = [{'ax': axes, 'lines': [], 'count': 0}]
-
-    # Create timestep count, to be shared between threads
-    ticks = [0]
+    # Make spike-train state for all neurons
+    state = make_state(axes, args.display_numbers)
 
     # Create a Bluetooth or IP socket depending on address format
     client = (socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM,
@@ -175,32 +486,40 @@ def main():
                   (args.address, args.port))
             sleep(1)
 
-    connected = [True]
+    # Signal the client thread to quit on plot close
+    stop = threading.Event()
+    fig.canvas.mpl_connect('close_event', lambda event: stop.set())
 
     # Start the client thread
     thread = threading.Thread(
             target=threadfun,
-            args=(client, fig, spiketrains, len(neuron_ids), connected,
-                  args.logarithmic))
+            args=(client, stop, state))
     thread.start()
 
-    # Star the animation thread
-    ani = animation.FuncAnimation(
-            fig=fig,
-            func=animfun,
-            fargs=(spiketrains, ticks, args.display_numbers, connected,
-                   args.logarithmic, args.timespan),
-            cache_frame_data=False,
-            interval=1)
+    # Scroll the 100-tick window across the time span
+    interval = args.timespan // 100
+
+    period_table = make_period_table(interval, args.logarithmic)
+
+    # Redraw only the spike trains and labels on each tick
+    blitter = BlitManager(fig.canvas, state.collections + state.labels)
+
+    # Record displayed frames to video file if indicated
+    video = (VideoWriter(args.video, VIDEO_FPS)
+             if args.video is not None else None)
+
+    # Start the animation timer
+    timer = fig.canvas.new_timer(interval=interval)
+    timer.add_callback(animate, state, period_table, blitter, video)
+    timer.start()
 
     plt.show()
 
-    # Save video file if indicated
-    if args.video is not None:
+    # Finish saving video file if indicated
+    if video is not None:
         print(('Saving animation to ' + args.video), end=' ... ')
         stdout.flush()
-        ani.save(args.video, writer=animation.FFMpegWriter(fps=30))
-        print()
+        print('done' if video.close() else 'failed')
 
 
 main()